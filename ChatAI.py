@@ -1,13 +1,23 @@
+import gc
 import json
-import requests
+import asyncio # Cooperative tasks so the UI stays live during API calls
 import network # Import network module for Wi-Fi
 import time # Import time for potential sleep_ms
+from collections import deque
 from lib.display import Display
 from lib.userinput import UserInput
 from lib.hydra import popup, beeper, config
 from lib.device import Device
 
 # --- Globals ---
+# Set to True to log progress on the serial console; printing over USB-CDC can block for tens of ms
+DEBUG = False
+if DEBUG:
+    dbg = print
+else:
+    def dbg(*args):
+        pass
+
 # Use use_tiny_buf=True for memory efficiency
 d = Display(use_tiny_buf=True)
 kb = UserInput()
@@ -16,15 +26,38 @@ b = beeper.Beeper()
 cfg = config.Config()
 
 W, H = Device.display_width, Device.display_height
+# Pixel width of each printable ASCII character, measured once; other characters are cached on first use
+CHAR_W = {chr(c): d.get_total_width(chr(c)) for c in range(32, 127)}
 # Model name
 MODEL_NAME = "gemini-2.5-flash-lite"
-# Non-streaming API endpoint
-API_URL_BASE = f"https://generativelanguage.googleapis.com/v1beta/models/{MODEL_NAME}:generateContent?key="
+# Non-streaming API endpoint (requests are written by hand over a TLS stream)
+API_HOST = "generativelanguage.googleapis.com"
+API_PATH_BASE = f"/v1beta/models/{MODEL_NAME}:generateContent?key="
+
+# Bytes per read while streaming the response body
+READ_CHUNK = 64
+# Redraw the reply after this many new bytes of text have been decoded
+REDRAW_EVERY = 16
+
+# Response scanner states: looking for TEXT_KEY, expecting its value, inside the string,
+# after a backslash, inside a \uXXXX escape, finished
+SCAN_SEEK, SCAN_VALUE, SCAN_STRING, SCAN_ESCAPE, SCAN_UNICODE, SCAN_DONE = range(6)
+TEXT_KEY = b'"text"'
+# Bytes allowed between TEXT_KEY and the opening quote of its value
+JSON_SEPARATORS = (0x20, 0x3A, 0x0A, 0x0D, 0x09) # Space, colon, newline, return, tab
+# JSON escape letters (as byte values) and the bytes they stand for
+JSON_ESCAPES = {0x6E: b'\n', 0x74: b'\t', 0x72: b'\r', 0x62: b'\b', 0x66: b'\f',
+                0x22: b'"', 0x5C: b'\\', 0x2F: b'/'}
+
+# Keep-alive (reader, writer) stream to API_HOST, reused across turns to skip the TLS handshake
+api_conn = None
+# Request line and fixed headers up to the Content-Length value, built once for the API key
+api_request_head = None
 
-# Stores conversation history for API
-conversation = []
 # Max number of conversation turns to send to the API (user + model pairs)
 MAX_CONVERSATION_HISTORY = 5 # Keep last 5 user/model pairs + current user message
+# Stores conversation history for API; older entries fall off the front automatically
+conversation = deque((), MAX_CONVERSATION_HISTORY * 2)
 
 # System prompt for the AI model
 # This tells the AI how to behave (in English, as per request)
@@ -32,15 +65,42 @@ SYSTEM_PROMPT = {
     "role": "user",
     "parts": [{"text": "You are a helpful and friendly assistant running on small M3 Cardputer device, designed for children aged 10-12. Use simple language and explain things clearly. Keep your responses to one or two short sentences."}]
 }
+# The system prompt and generation config never change, so they are JSON-encoded once here
+SYSTEM_PROMPT_JSON = json.dumps(SYSTEM_PROMPT).encode('utf-8')
+GENCFG_JSON = json.dumps({"maxOutputTokens": 50}).encode('utf-8') # Roughly 1-2 short sentences
+# Opening bytes of each history entry, by role, up to its 'parts' value
+ENTRY_JSON_HEAD = {"user": b',{"role":"user","parts":', "model": b',{"role":"model","parts":'}
+# Request bodies are serialised into this one buffer, so a turn doesn't allocate a fresh payload
+PAYLOAD_BUF = bytearray(2048)
+
+# After Enter, wait this long for more messages so back-to-back lines share one API call
+BATCH_WINDOW_MS = 300
 
 # Variable to hold the current user input being typed
 current_user_input = "" 
+# Messages entered while a request is in flight; they join the conversation once it finishes
+queued_messages = []
+
+# Screen layout: history sits between the header divider and the input line
+HISTORY_TOP = 13
+INPUT_Y = H - 10
+# Newest entry as last drawn (its top row and line count) so streamed text can redraw just its rows
+last_drawn_entry = None
+last_drawn_y = HISTORY_TOP
+last_line_count = 0
 
 # --- Functions ---
 
+def disable_power_save(nic):
+    """Turns off WiFi modem sleep, which adds DTIM-interval latency to every request."""
+    try:
+        nic.config(pm=nic.PM_NONE)
+    except (AttributeError, ValueError): # Port without power-management control
+        pass
+
 def connect_wifi():
     """Connects to Wi-Fi using credentials from config."""
-    print("WiFi: Attempting to connect...")
+    dbg("WiFi: Attempting to connect...")
     nic = network.WLAN(network.STA_IF)
     if not nic.active():
         nic.active(True)
@@ -49,47 +109,79 @@ def connect_wifi():
     password = cfg['wifi_pass']
 
     if not ssid or not password:
-        print("WiFi: Missing 'wifi_ssid' or 'wifi_pass' in config!")
+        dbg("WiFi: Missing 'wifi_ssid' or 'wifi_pass' in config!")
         ov.error("No WiFi credentials!")
         time.sleep(3) # Display error for a few seconds
         return False
 
     if nic.isconnected():
-        print(f"WiFi: Already connected to {ssid}")
+        dbg(f"WiFi: Already connected to {ssid}")
+        disable_power_save(nic)
         return True
 
     # Try connecting
     nic.connect(ssid, password)
-    max_retries = 20 # ~10 seconds with 500ms sleep
+    max_retries = 200 # ~10 seconds with 50ms sleep
     retries = 0
+    # Statuses that mean association has given up; MicroPython's WLAN has no connect IRQ,
+    # so nic.status() is the earliest signal available. Missing constants are skipped.
+    fail_statuses = [getattr(network, name) for name in ("STAT_WRONG_PASSWORD", "STAT_NO_AP_FOUND", "STAT_CONNECT_FAIL")
+                     if hasattr(network, name)]
 
     d.text("Connecting WiFi...", 2, H - 10, d.palette[9])
     d.show()
 
     while not nic.isconnected() and retries < max_retries:
-        time.sleep_ms(500)
+        if nic.status() in fail_statuses:
+            break # No point waiting out the timeout
+        time.sleep_ms(50)
         retries += 1
-        d.text(f"Connecting WiFi... {retries}", 2, H - 10, d.palette[9])
-        d.show()
-        print(f"WiFi: Connecting... attempt {retries}")
+        if retries % 20 == 0: # Only redraw once per second
+            d.text(f"Connecting WiFi... {retries // 20}", 2, H - 10, d.palette[9])
+            d.show()
+            dbg(f"WiFi: Connecting... {retries // 20}s")
     
     # Clear "Connecting WiFi" message
     d.rect(0, H - 10, W, 10, d.palette[2], fill=True)
     d.show()
 
     if nic.isconnected():
-        print(f"WiFi: Connected! IP: {nic.ifconfig()[0]}")
+        dbg(f"WiFi: Connected! IP: {nic.ifconfig()[0]}")
+        disable_power_save(nic)
         return True
     else:
-        print("WiFi: Failed to connect.")
+        dbg("WiFi: Failed to connect.")
         ov.error("WiFi connection failed!")
         time.sleep(3) # Display error for a few seconds
         return False
 
+def char_width(char):
+    """Returns the pixel width of a single character from CHAR_W."""
+    char_px = CHAR_W.get(char)
+    if char_px is None:
+        char_px = CHAR_W[char] = d.get_total_width(char)
+    return char_px
+
+def bisect_right(values, x, lo=0):
+    """Returns the index after the last item <= x in the sorted list values (MicroPython has no bisect)."""
+    hi = len(values)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if x < values[mid]:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
 def wrap_text(text, width):
     """Wraps text into lines based on pixel width."""
+    # Local names are a single bytecode load in the loops below, unlike global/attribute lookups
+    cw = char_width
     lines = []
+    add_line = lines.append
     current_line = ""
+    line_px = 0 # Running pixel width of current_line
+    space_px = CHAR_W[' ']
     # Ensure text is treated as a string before splitting
     text_str = str(text) 
     # Handle the case of an empty string
@@ -98,208 +190,541 @@ def wrap_text(text, width):
 
     for word in text_str.split(' '):
         # Handle cases where a single word might be longer than the line width
-        word_width = d.get_total_width(word)
-        if word_width > width:
-            # If a single word is too long, break it into parts that fit
-            temp_word_part = ""
+        word_px = 0
+        for char in word:
+            word_px += cw(char)
+        if word_px > width:
+            if current_line: add_line(current_line.strip()) # Don't drop the words before it
+            # If a single word is too long, break it into parts that fit. Prefix sums of the
+            # character widths are sorted, so each split point is a binary search.
+            prefix = [0]
             for char in word:
-                if d.get_total_width(temp_word_part + char) <= width:
-                    temp_word_part += char
-                else:
-                    if temp_word_part: lines.append(temp_word_part)
-                    temp_word_part = char # Start new part with the current char
-            if temp_word_part: lines.append(temp_word_part) # Add any remaining part
+                prefix.append(prefix[-1] + cw(char))
+            start = 0
+            while start < len(word):
+                split = bisect_right(prefix, prefix[start] + width, start) - 1
+                if split <= start: split = start + 1 # A lone over-wide char still gets its own part
+                add_line(word[start:split])
+                start = split
             current_line = "" # Reset current_line after handling long word
+            line_px = 0
             continue
 
         # Check if adding the next word (with a space if needed) fits
-        next_line_candidate = current_line + (' ' if current_line else '') + word
-        if d.get_total_width(next_line_candidate) <= width:
-            current_line = next_line_candidate
+        candidate_px = line_px + (space_px if current_line else 0) + word_px
+        if candidate_px <= width:
+            current_line = current_line + (' ' if current_line else '') + word
+            line_px = candidate_px
         else:
-            if current_line: lines.append(current_line.strip())
+            if current_line: add_line(current_line.strip())
             current_line = word # Start a new line with the current word
-    if current_line: lines.append(current_line.strip())
+            line_px = word_px
+    if current_line: add_line(current_line.strip())
     return lines
 
-def draw_ui():
-    """Renders the chat interface: history and hints."""
-    global current_user_input # Declare access to global variable
-    d.rect(0, 0, W, H, d.palette[2], fill=True) # Clear screen
+def entry_lines(entry):
+    """Returns the entry's wrapped lines, wrapping them into '_lines' if not cached yet."""
+    # Wrapped lines are cached on the entry; whoever changes the text resets '_lines'
+    if entry.get('_lines') is None:
+        prefix = "You: " if entry['role'] == 'user' else "Bot: "
+        entry['_lines'] = wrap_text(prefix + entry['parts'][0]['text'], W - 4)
+    return entry['_lines']
+
+def draw_header():
+    """Draws the model name and the divider below it."""
     # Shortened name for UI
     d.text(f"Model: Flash-Lite", 2, 2, d.palette[9]) 
     d.line(0, 12, W, 12, d.palette[8])
 
-    # Draw input prompt line
-    input_line_y = H - 10
-    d.line(0, input_line_y - 2, W, input_line_y - 2, d.palette[8])
-    d.text(f"Input: {current_user_input}", 2, input_line_y, d.palette[10]) # Display current input
-
-    y = input_line_y - 12 # Start drawing history above the input line
-    # Draw history from bottom up, excluding the SYSTEM_PROMPT if it's there
-    display_conversation = [entry for entry in conversation if entry != SYSTEM_PROMPT]
-
-    for entry in reversed(display_conversation): 
-        role = entry['role']
-        # Use d.palette[13] (blue-ish) for bot's text
-        color = d.palette[10] if role == 'user' else d.palette[13] 
-        prefix = "You: " if role == 'user' else "Bot: "
+def draw_input():
+    """Redraws only the input prompt line."""
+    global current_user_input # Declare access to global variable
+    pal = d.palette
+    d.rect(0, INPUT_Y, W, H - INPUT_Y, pal[2], fill=True)
+    d.line(0, INPUT_Y - 2, W, INPUT_Y - 2, pal[8])
+    label = f"Input (+{len(queued_messages)}): " if queued_messages else "Input: "
+    d.text(label + current_user_input, 2, INPUT_Y, pal[10]) # Display current input
+
+def draw_history(dirty_from_y=HISTORY_TOP):
+    """Clears and redraws the history rows from dirty_from_y down to the input divider."""
+    global last_drawn_entry, last_drawn_y, last_line_count
+    # Bind display attributes to locals once; they are used for every line drawn
+    pal = d.palette
+    user_color = pal[10]
+    bot_color = pal[13] # Blue-ish for bot's text
+    text = d.text
+    d.rect(0, dirty_from_y, W, INPUT_Y - 2 - dirty_from_y, pal[2], fill=True)
+    top = max(dirty_from_y, HISTORY_TOP + 1) # Rows above this are left untouched
+
+    y = INPUT_Y - 12 # Start drawing history above the input line
+    # Draw history from bottom up; SYSTEM_PROMPT is only ever added to the payload, never to conversation
+    last_drawn_entry = conversation[-1] if conversation else None
+    for entry in reversed(conversation): 
+        color = user_color if entry['role'] == 'user' else bot_color
         
         # Ensure 'text' part exists before accessing
         if 'text' in entry['parts'][0]:
-            lines = wrap_text(prefix + entry['parts'][0]['text'], W - 4)
+            lines = entry_lines(entry)
+            if entry is last_drawn_entry: # Remember where the newest entry sits for draw_newest()
+                last_line_count = len(lines)
+                last_drawn_y = max(y - 10 * len(lines), HISTORY_TOP)
             for line in reversed(lines):
                 y -= 10
-                if y < 14: break # Stop if approaching model name/line
-                d.text(line, 2, y, color)
-            if y < 14: break # Stop if approaching model name/line
-            
+                if y < top: break # Stop if approaching model name/line or the clean rows
+                text(line, 2, y, color)
+            if y < top: break # Stop if approaching model name/line or the clean rows
+
+def draw_newest():
+    """Redraws after the newest entry's text changed, touching only its rows unless it grew a line."""
+    entry = conversation[-1]
+    if entry is last_drawn_entry and len(entry_lines(entry)) == last_line_count:
+        draw_history(last_drawn_y)
+    else:
+        draw_history() # The new line scrolls everything above it
+    d.show()
+
+def draw_ui():
+    """Renders the whole chat interface: header, history and input line."""
+    d.rect(0, 0, W, H, d.palette[2], fill=True) # Clear screen
+    draw_header()
+    draw_history()
+    draw_input()
     d.show()
 
-def call_gemini_api(api_key):
+async def read_headers(reader):
+    """Reads the HTTP status line and headers, returns (status, content_length, chunked, reusable)."""
+    status_line = await reader.readline()
+    if not status_line:
+        raise OSError("Connection closed")
+    status = int(status_line.split(b' ')[1])
+    length = None
+    chunked = False
+    keep_alive = True
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''): # Blank line ends the headers
+            break
+        name, value = line.decode('utf-8').split(':', 1)
+        name = name.strip().lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'transfer-encoding':
+            chunked = 'chunked' in value.lower()
+        elif name == 'connection':
+            keep_alive = 'close' not in value.lower()
+    # Without a length the body ends when the server closes, so the stream can't be reused
+    return status, length, chunked, keep_alive and (length is not None or chunked)
+
+async def stream_exactly(reader, n, on_data):
+    """Passes exactly n bytes from reader to on_data, READ_CHUNK bytes at a time."""
+    while n > 0:
+        data = await reader.read(min(n, READ_CHUNK))
+        if not data:
+            raise OSError("Connection closed")
+        n -= len(data)
+        on_data(data)
+
+async def read_body(reader, length, chunked, on_data):
+    """Streams the HTTP response body to on_data using Content-Length or chunked encoding."""
+    if chunked:
+        while True:
+            size = int((await reader.readline()).split(b';')[0].strip(), 16)
+            if not size:
+                await reader.readline() # Final CRLF after the last chunk
+                return
+            await stream_exactly(reader, size, on_data)
+            await reader.readline() # CRLF after each chunk
+    elif length is None: # No length given, read until the server closes
+        while True:
+            data = await reader.read(READ_CHUNK)
+            if not data:
+                return
+            on_data(data)
+    else:
+        await stream_exactly(reader, length, on_data)
+
+class TextScanner:
+    """Pulls the first JSON "text" string out of a response body as it streams in."""
+
+    def __init__(self):
+        self.state = SCAN_SEEK
+        self.head = b"" # Body before the text; the whole body if no text is found
+        self.hex = "" # Digits of a pending \uXXXX escape
+        self.out = bytearray() # Unescaped UTF-8 text found so far
+        self.taken = 0 # Bytes of out already returned by take()
+
+    def feed(self, data):
+        """Consumes the next piece of the response body."""
+        if self.state == SCAN_SEEK:
+            # Search the kept head so a key split across two pieces is still found
+            seek_from = max(0, len(self.head) - len(TEXT_KEY) + 1)
+            self.head += data
+            found = self.head.find(TEXT_KEY, seek_from)
+            if found < 0:
+                return
+            data = self.head[found + len(TEXT_KEY):]
+            self.head = b""
+            self.state = SCAN_VALUE
+        out = self.out
+        i = 0
+        n = len(data)
+        while i < n:
+            state = self.state
+            if state == SCAN_STRING:
+                # Copy everything up to the next quote or backslash as one slice
+                quote = data.find(b'"', i)
+                if quote < 0:
+                    quote = n
+                backslash = data.find(b'\\', i, quote)
+                stop = quote if backslash < 0 else backslash
+                out.extend(data[i:stop])
+                if stop == n:
+                    return
+                i = stop + 1
+                if backslash < 0: # Closing quote
+                    self.state = SCAN_DONE
+                    return
+                self.state = SCAN_ESCAPE
+                continue
+            c = data[i]
+            i += 1
+            if state == SCAN_VALUE:
+                if c == 0x22: # Opening quote of the value
+                    self.state = SCAN_STRING
+                elif c not in JSON_SEPARATORS: # "text" wasn't a key after all, keep looking
+                    self.state = SCAN_SEEK
+                    self.feed(data[i:])
+                    return
+            elif state == SCAN_ESCAPE:
+                if c == 0x75: # \uXXXX
+                    self.hex = ""
+                    self.state = SCAN_UNICODE
+                else:
+                    out.extend(JSON_ESCAPES.get(c, b'?'))
+                    self.state = SCAN_STRING
+            elif state == SCAN_UNICODE:
+                self.hex += chr(c)
+                if len(self.hex) == 4:
+                    code = int(self.hex, 16)
+                    if code < 0xD800 or code > 0xDFFF:
+                        out.extend(chr(code).encode('utf-8'))
+                    elif code >= 0xDC00: # Surrogate pair (emoji), which the font can't draw anyway
+                        out.extend(b'?')
+                    self.state = SCAN_STRING
+            else:
+                return
+
+    def pending(self):
+        """Returns how many bytes of text have arrived since the last take()."""
+        return len(self.out) - self.taken
+
+    def take(self):
+        """Returns the text completed since the last call, holding back a split UTF-8 character."""
+        out = self.out
+        end = len(out)
+        lead = end - 1
+        while lead > self.taken and out[lead] & 0xC0 == 0x80: # Continuation bytes
+            lead -= 1
+        if lead >= self.taken and out[lead] >= 0xC0:
+            size = 2 if out[lead] < 0xE0 else 3 if out[lead] < 0xF0 else 4
+            if end - lead < size:
+                end = lead
+        text = str(out[self.taken:end], 'utf-8')
+        self.taken = end
+        return text
+
+async def open_api_conn():
+    """Returns the cached API connection, opening a new TLS stream if needed."""
+    global api_conn
+    if api_conn is None:
+        dbg("API: Opening TLS connection.")
+        gc.collect() # Free garbage before the handshake's large allocations (the GC does not compact)
+        api_conn = await asyncio.open_connection(API_HOST, 443, ssl=True)
+    return api_conn
+
+def close_api_conn():
+    """Closes and forgets the cached API connection."""
+    global api_conn
+    if api_conn:
+        api_conn[1].close()
+        api_conn = None
+
+async def api_post(api_key, body):
+    """POSTs body on the keep-alive connection, returns (reader, status, length, chunked, reusable)."""
+    global api_request_head
+    if api_request_head is None:
+        api_request_head = (
+            f"POST {API_PATH_BASE}{api_key} HTTP/1.1\r\n"
+            f"Host: {API_HOST}\r\n"
+            "Content-Type: application/json\r\n"
+            "Connection: keep-alive\r\n"
+            "Content-Length: "
+        ).encode('utf-8')
+    length_line = str(len(body)).encode('utf-8') + b"\r\n\r\n"
+
+    # open_connection wraps a non-blocking socket in TLS, so every await below yields
+    # to the key poller and spinner instead of stalling the whole device.
+    while True:
+        reused = api_conn is not None
+        reader, writer = await open_api_conn()
+        try:
+            writer.write(api_request_head)
+            writer.write(length_line)
+            writer.write(body)
+            await writer.drain()
+            return (reader,) + await read_headers(reader)
+        except OSError:
+            # The server may have dropped an idle keep-alive connection; retry once on a fresh one
+            close_api_conn()
+            if not reused: raise
+            dbg("API: Stale connection, reconnecting.")
+
+def put_bytes(buf, n, data):
+    """Copies data into buf at offset n, growing buf if needed, and returns the new offset."""
+    end = n + len(data)
+    if end > len(buf):
+        buf.extend(bytearray(max(end - len(buf), len(buf)))) # Double so growth happens rarely
+    buf[n:end] = data
+    return end
+
+def build_payload_into(buf, history):
+    """Serialises the request body into buf and returns the number of bytes used."""
+    # SYSTEM_PROMPT goes first. Only 'role' and 'parts' of each entry are sent;
+    # local fields like '_lines' would be rejected by the API.
+    n = put_bytes(buf, 0, b'{"contents":[')
+    n = put_bytes(buf, n, SYSTEM_PROMPT_JSON)
+    for entry in history:
+        n = put_bytes(buf, n, ENTRY_JSON_HEAD[entry['role']])
+        n = put_bytes(buf, n, json.dumps(entry['parts']).encode('utf-8'))
+        n = put_bytes(buf, n, b'}')
+    n = put_bytes(buf, n, b'],"generationConfig":')
+    n = put_bytes(buf, n, GENCFG_JSON)
+    return put_bytes(buf, n, b'}')
+
+async def call_gemini_api(api_key):
     """Sends a request and handles the full response, updating the UI."""
     # Ensure WiFi is connected before making an API call
     if not network.WLAN(network.STA_IF).isconnected():
-        print("API: WiFi not connected, attempting to reconnect...")
+        dbg("API: WiFi not connected, attempting to reconnect...")
         if not connect_wifi():
             ov.error("API: No network!")
             time.sleep(3) # Display error for a few seconds
             return
 
-    print("API: Starting request.")
+    dbg("API: Starting request.")
     # Add a placeholder for the model's response
-    bot_response_entry = {"role": "model", "parts": [{"text": ""}]}
+    bot_response_entry = {"role": "model", "parts": [{"text": ""}], "_lines": None}
     
-    # Prepare conversation history for the API call
-    # Always include the SYSTEM_PROMPT at the very beginning of the payload_contents
-    payload_contents = [SYSTEM_PROMPT] # Start with the system prompt
-
-    # Limit history to MAX_CONVERSATION_HISTORY user-bot pairs + current user message
-    # We take the actual conversation (excluding the initial SYSTEM_PROMPT if it was ever added locally)
-    # and then add the relevant recent turns.
-    actual_conversation_for_history = [entry for entry in conversation if entry != SYSTEM_PROMPT]
-    start_index = max(0, len(actual_conversation_for_history) - MAX_CONVERSATION_HISTORY * 2)
-    payload_contents.extend(actual_conversation_for_history[start_index:]) 
+    # The payload sent to the API contains the history (already limited to MAX_CONVERSATION_HISTORY
+    # user-bot pairs + current user message by the deque) but *without* the empty
+    # bot_response_entry (as the API generates it).
+    payload = memoryview(PAYLOAD_BUF)[:build_payload_into(PAYLOAD_BUF, conversation)]
 
     # We need to append the placeholder for the bot's response to the *local* conversation
-    # immediately, so draw_ui() can render it as "Bot: " while fetching.
+    # immediately, so draw_newest() can render it as "Bot: " while fetching.
+    # When the deque is full this pushes out the oldest turn, which failures must put back.
+    evicted = conversation[0] if len(conversation) == MAX_CONVERSATION_HISTORY * 2 else None
     conversation.append(bot_response_entry)
 
-    headers = {'Content-Type': 'application/json'}
-    # The payload sent to the API contains the limited history *without* the empty bot_response_entry
-    # (as the API generates it).
-    
-    # Add generationConfig to limit output length
-    payload = json.dumps({
-        "contents": payload_contents,
-        "generationConfig": {
-            "maxOutputTokens": 50 # Roughly 1-2 short sentences
-        }
-    })
-    
-    print(f"API: Payload size: {len(payload)} bytes")
+    def remove_placeholder():
+        conversation.pop() # Remove the empty bot response entry
+        if evicted is not None:
+            conversation.appendleft(evicted) # Restore the turn the placeholder pushed out
     
+    dbg(f"API: Payload size: {len(payload)} bytes")
+
     try:
-        url = API_URL_BASE + api_key
-        r = requests.post(url, headers=headers, data=payload) 
+        reader, status, length, chunked, reusable = await api_post(api_key, payload)
 
-        if r.status_code != 200:
-            err_msg = f"HTTP Error: {r.status_code}"
+        if status != 200:
+            body = bytearray()
+            await read_body(reader, length, chunked, body.extend)
+            if not reusable: close_api_conn()
+            err_msg = f"HTTP Error: {status}"
             try: # Try to read error message from content if available
-                err_content = r.content.decode('utf-8')
+                err_content = str(body, 'utf-8')
                 if err_content: err_msg += f" - {err_content[:50]}" # Limit length
             except:
                 pass
-            print(f"API: {err_msg}")
+            dbg(f"API: {err_msg}")
             ov.error(err_msg)
             time.sleep(3) # Display error for a few seconds
-            conversation.pop() # Remove the empty bot response entry
-            r.close()
+            remove_placeholder()
             return
 
-        # Process the full response
-        try:
-            data = json.loads(r.content.decode('utf-8'))
-            # Check for 'candidates' and 'parts' before accessing
-            if 'candidates' in data and len(data['candidates']) > 0 and \
-               'content' in data['candidates'][0] and \
-               'parts' in data['candidates'][0]['content'] and \
-               len(data['candidates'][0]['content']['parts']) > 0 and \
-               'text' in data['candidates'][0]['content']['parts'][0]:
-                
-                full_text_response = data['candidates'][0]['content']['parts'][0]['text']
-                bot_response_entry['parts'][0]['text'] = full_text_response # Assign full text
-                b.play(("C7",), 10, 2) # Play sound once after full response
-                draw_ui()
-            else:
-                print("API: Unexpected response structure.")
-                ov.error("Bad API Response")
-                time.sleep(3) # Display error for a few seconds
-        except (json.JSONDecodeError, KeyError, IndexError) as e:
-            print(f"API: Error parsing full JSON response: {e}, Content: {r.content.decode('utf-8')[:100]}")
-            ov.error("JSON Parse Error")
+        # Stream the response, showing the reply as it arrives instead of after the whole body
+        scanner = TextScanner()
+        text_part = bot_response_entry['parts'][0]
+
+        def show_new_text():
+            text_part['text'] += scanner.take()
+            bot_response_entry['_lines'] = None # Re-wrap on next draw
+            draw_newest()
+
+        def on_data(data):
+            scanner.feed(data)
+            if scanner.pending() >= REDRAW_EVERY:
+                show_new_text()
+
+        await read_body(reader, length, chunked, on_data)
+        if not reusable: close_api_conn()
+
+        if scanner.state == SCAN_DONE:
+            show_new_text()
+            b.play(("C7",), 10, 2) # Play sound once after full response
+        else:
+            dbg("API: Unexpected response structure.")
+            err_msg = "Bad API Response"
+            if scanner.state == SCAN_SEEK:
+                try: # No text anywhere, so the scanner kept the whole body; parse it to see why
+                    data = json.loads(str(scanner.head, 'utf-8'))
+                    reason = data.get('promptFeedback', {}).get('blockReason') or \
+                             data['candidates'][0].get('finishReason')
+                    if reason: err_msg += f" ({reason})"
+                except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+                    pass
+            ov.error(err_msg)
             time.sleep(3) # Display error for a few seconds
         
-        r.close() # Close the response connection
-        print("API: Request finished.")
+        dbg("API: Request finished.")
+    except asyncio.CancelledError:
+        dbg("API: Request cancelled.")
+        close_api_conn() # A half-read response leaves the stream unusable
+        remove_placeholder()
+        raise
     except Exception as e:
-        print(f"API: Request failed with exception: {e}")
+        dbg(f"API: Request failed with exception: {e}")
+        close_api_conn()
         ov.error(f"Request Fail: {e}")
         time.sleep(3) # Display error for a few seconds
-        if conversation: conversation.pop() # Remove the empty bot response entry
+        remove_placeholder()
+
+def edit_input(k):
+    """Applies a BS, SPC or character key to the input line and redraws it."""
+    global current_user_input # Declare access to global variable
+    if k == "BS": # Backspace
+        current_user_input = current_user_input[:-1] # Remove last character
+    elif len(k) == 1: # Assume single character keys are for input
+        # Check if adding the character exceeds display width
+        if d.get_total_width(current_user_input + k) > (W - 4): # Allow 4px margin
+            dbg(f"App: Input line full, cannot add '{k}'")
+            return
+        current_user_input += k
+    elif k == "SPC": # Space key
+        if d.get_total_width(current_user_input + ' ') > (W - 4):
+            dbg("App: Input line full, cannot add space.")
+            return
+        current_user_input += ' '
+    else:
+        return
+    draw_input() # Redraw to show the change
+    d.show()
 
-def main():
+async def poll_keys(task):
+    """Handles the keyboard while a request is in flight; ESC cancels it, other keys keep editing."""
+    global current_user_input # Declare access to global variable
+    while True:
+        for k in kb.get_new_keys():
+            if k == "ESC":
+                dbg("App: ESC pressed, cancelling request.")
+                task.cancel()
+                # Lines queued behind the cancelled request shouldn't go out on their own
+                queued_messages.clear()
+                return
+            elif k == "ENT":
+                if current_user_input.strip(): # Held back and sent as the next batch
+                    dbg(f"App: User input queued: '{current_user_input}'")
+                    queued_messages.append(current_user_input)
+                    current_user_input = "" # Clear input after queueing
+                    draw_input()
+                    d.show()
+            else:
+                edit_input(k)
+        await asyncio.sleep_ms(20)
+
+async def spinner():
+    """Animates a "Thinking..." indicator on the input line until cancelled."""
+    frames = "|/-\\"
+    frame = 0
+    while True:
+        if not current_user_input: # Don't hide text being typed for the next message
+            d.rect(0, INPUT_Y, W, H - INPUT_Y, d.palette[2], fill=True)
+            queued = f" (+{len(queued_messages)})" if queued_messages else "" # Keep queued lines visible
+            d.text(f"Thinking... {frames[frame % len(frames)]}{queued}", 2, INPUT_Y, d.palette[9])
+            d.show()
+        frame += 1
+        await asyncio.sleep_ms(150)
+
+async def send_message(api_key):
+    """Runs the API call alongside the key poller and spinner, then restores the UI."""
+    api_task = asyncio.create_task(call_gemini_api(api_key))
+    helpers = (asyncio.create_task(poll_keys(api_task)), asyncio.create_task(spinner()))
+    try:
+        await api_task
+    except asyncio.CancelledError:
+        pass # ESC during the request; call_gemini_api already cleaned up
+    for task in helpers:
+        task.cancel()
+    draw_ui() # Replace the spinner and any error popup
+
+async def main():
     """Main application loop."""
     global current_user_input # Declare access to global variable
-    print("App: Starting.")
+    dbg("App: Starting.")
     d.rect(0,0,1,1,d.palette[2]); d.show()
 
     # Access config value using dictionary-style access
     api_key = cfg['gemini_api_key'] 
     if not api_key:
-        print("App: Error - gemini_api_key not found in config!")
+        dbg("App: Error - gemini_api_key not found in config!")
         ov.error("Set gemini_api_key in config!")
         time.sleep(3) # Display error for a few seconds
         return
 
     # Attempt to connect to WiFi at startup
     if not connect_wifi():
-        print("App: Initial WiFi connection failed. Continuing without network access.")
+        dbg("App: Initial WiFi connection failed. Continuing without network access.")
     
     draw_ui() # Draw initial UI with empty input line
+    send_at = None # Tick at which queued user messages are sent, None if nothing is queued
 
     while True:
         # Check for key presses
-        for k in kb.get_new_keys():
+        keys = kb.get_new_keys()
+        for k in keys:
             if k == "ESC":
-                print("App: ESC pressed, exiting.")
+                dbg("App: ESC pressed, exiting.")
                 raise SystemExit
             elif k == "ENT":
                 if current_user_input.strip(): # Only send if input is not empty
-                    print(f"App: User input received: '{current_user_input}'")
-                    conversation.append({"role": "user", "parts": [{"text": current_user_input}]})
+                    dbg(f"App: User input received: '{current_user_input}'")
+                    conversation.append({"role": "user", "parts": [{"text": current_user_input}], "_lines": None})
                     current_user_input = "" # Clear input after sending
-                    draw_ui() # Redraw UI with new message and empty input
-                    call_gemini_api(api_key)
-                else:
-                    print("App: Empty message entered (ENT pressed).")
-            elif k == "BS": # Backspace
-                current_user_input = current_user_input[:-1] # Remove last character
-                draw_ui() # Redraw to show deletion
-            elif len(k) == 1: # Assume single character keys are for input
-                # Check if adding the character exceeds display width
-                if d.get_total_width(current_user_input + k) <= (W - 4): # Allow 4px margin
-                    current_user_input += k
-                    draw_ui() # Redraw to show new character
-                else:
-                    print(f"App: Input line full, cannot add '{k}'")
-            elif k == "SPC": # Space key
-                if d.get_total_width(current_user_input + ' ') <= (W - 4):
-                    current_user_input += ' '
-                    draw_ui()
+                    # Redraw history with new message and empty input
+                    draw_history()
+                    draw_input()
+                    d.show()
+                    # Lines entered within BATCH_WINDOW_MS of each other go out as one request
+                    send_at = time.ticks_add(time.ticks_ms(), BATCH_WINDOW_MS)
                 else:
-                    print("App: Input line full, cannot add space.")
-
-        time.sleep_ms(20) # Small delay to prevent busy-looping
-
-main()
+                    dbg("App: Empty message entered (ENT pressed).")
+            else:
+                edit_input(k)
+
+        if send_at is not None and time.ticks_diff(time.ticks_ms(), send_at) >= 0:
+            send_at = None
+            await send_message(api_key)
+            if queued_messages: # Lines entered during the request form the next batch
+                for text in queued_messages:
+                    conversation.append({"role": "user", "parts": [{"text": text}], "_lines": None})
+                queued_messages.clear()
+                draw_history()
+                draw_input()
+                d.show()
+                send_at = time.ticks_add(time.ticks_ms(), BATCH_WINDOW_MS)
+
+        # UserInput has no IRQ to block on, so just yield after handling keys and
+        # back off briefly when the keyboard is idle; keeps key latency at ~5 ms.
+        await asyncio.sleep_ms(0 if keys else 5)
+
+asyncio.run(main())